@@ -1,6 +1,7 @@
+import asyncio
+import heapq
 import sys
-import threading
-import requests
+import httpx
 import os
 from dataclasses import dataclass
 import time
@@ -12,142 +13,263 @@ from prom_client import PromMetricsClient
 
 logger = logging.getLogger(__name__)
 
-BWSC_URL = os.environ.get("BWS_CACHE_URL")
+BWSC_URL = os.environ.get("BWS_CACHE_URL", "")
 SECRET_TTL = int(os.environ.get("SECRET_TTL", 15))
 KEEP_ON_CONN_FAIL = os.environ.get("KEEP_ON_CONN_FAIL", "false").lower() == "true"
 BACKGROUND_REFRESH = os.environ.get("BACKGROUND_REFRESH", "false").lower() == "true"
+# stale entries are only served, while being revalidated, up to this age
+MAX_STALE_AGE = 2 * SECRET_TTL
+CACHE_MAX_SIZE = int(os.environ.get("CACHE_MAX_SIZE", "10000"))
+CLIENT_IDLE_TTL = int(os.environ.get("CLIENT_IDLE_TTL", "3600"))
 
 if not BWSC_URL:
     logger.critical("BWS_CACHE_URL not set")
     sys.exit(1)
 
+if CACHE_MAX_SIZE < 1:
+    logger.critical("CACHE_MAX_SIZE must be at least 1")
+    sys.exit(1)
+
 
 def generate_hash(value: str) -> str:
     return hashlib.sha256(value.encode("utf-8")).hexdigest()
 
 
-@dataclass
+# (endpoint, secret_id)
+CacheKey = tuple[str, str]
+
+
+@dataclass(slots=True)
 class SecretResponse:
-    value: str
+    value: bytes
     status_code: int
 
 
-@dataclass
+@dataclass(slots=True)
 class CachedSecret:
     value: SecretResponse
     last_requested: float
 
 
 class BwscCachedClient:
-    def __init__(self, token: str, prom_clien: PromMetricsClient):
+    def __init__(
+        self,
+        token: str,
+        prom_clien: PromMetricsClient,
+        http_client: httpx.AsyncClient,
+    ):
         self.token = token
+        # hashed once for stats labels so the raw token is never exposed
+        self.token_hash = generate_hash(token)
         self.prom_client = prom_clien
-        self.endpoint_cache: dict[str, CachedSecret] = {}
-        self.endpoint_cache_lock = threading.Lock()
+        self.http_client = http_client
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.last_used = time.monotonic()
+        # only touched from the event loop, so no locking is needed
+        # ordered by last refresh, so the first entry is the first to evict
+        self._cache: dict[CacheKey, CachedSecret] = {}
+        # successful (200) entries per endpoint, kept in step with _cache
+        self._ok_counts = {"id": 0, "key": 0}
+        # single-flight: one upstream request per key, concurrent callers wait
+        self._inflight: dict[CacheKey, asyncio.Event] = {}
+        self._background_tasks: set[asyncio.Task] = set()
+        # (expiry, key) min-heap for the background refresh loop; entries made
+        # stale by a newer refresh, eviction or reset are skipped when popped
+        self._expiry_heap: list[tuple[float, CacheKey]] = []
+        self._expiry_pushed = asyncio.Event()
         if BACKGROUND_REFRESH:
-            self.refresh_thread = threading.Thread(target=self._refresh_loop)
-            self.refresh_thread.daemon = True
-            self.refresh_thread.start()
+            self._spawn(self._refresh_loop())
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
 
-    def _refresh_loop(self):
+    async def _refresh_loop(self):
         while True:
-            min_sleep = None
-            expired_endpoints = []
-            with self.endpoint_cache_lock:
-                for url, cached_secret in self.endpoint_cache.items():
-                    current_time = time.time()
-                    time_till_expire = SECRET_TTL - (
-                        current_time - cached_secret.last_requested
-                    )
-                    if time_till_expire < 0:
-                        expired_endpoints.append(url)
-                    elif min_sleep is None or time_till_expire < min_sleep:
-                        min_sleep = time_till_expire
-            for url in expired_endpoints:
-                endpoint, secret_id = url.split("/")
-                self.refresh_endpoint(endpoint, secret_id)
-            if min_sleep is not None:
-                time.sleep(min_sleep)
+            if not self._expiry_heap:
+                self._expiry_pushed.clear()
+                await self._expiry_pushed.wait()
+                continue
+            # every push is now + SECRET_TTL, so nothing can jump ahead of
+            # the current head while we sleep
+            delay = self._expiry_heap[0][0] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            current_time = time.monotonic()
+            if current_time - self.last_used > CLIENT_IDLE_TTL:
+                # idle (likely rotated or revoked) token, stop calling
+                # upstream with it; the manager replaces this client if the
+                # token is used again
+                return
+            refreshes = []
+            while self._expiry_heap and self._expiry_heap[0][0] <= current_time:
+                expiry, key = heapq.heappop(self._expiry_heap)
+                cached_secret = self._cache.get(key)
+                if (
+                    cached_secret is None
+                    or cached_secret.last_requested + SECRET_TTL != expiry
+                ):
+                    continue
+                refreshes.append(self.refresh_endpoint(*key))
+            await asyncio.gather(*refreshes)
+
+    def close(self):
+        for task in list(self._background_tasks):
+            task.cancel()
 
     def reset_cache(self):
         before = self.stats()
-        self.endpoint_cache = {}
+        self._cache = {}
+        self._ok_counts = {"id": 0, "key": 0}
+        self._expiry_heap = []
         return before
 
-    def refresh_endpoint(self, endpoint: str, secret_id: str):
-        self.prom_client.tick_cache_miss(endpoint)
-        url = f"{endpoint}/{secret_id}"
+    def _evict(self, key: CacheKey):
+        cached_secret = self._cache.pop(key)
+        if cached_secret.value.status_code == 200:
+            self._ok_counts[key[0]] -= 1
+
+    def _store(self, key: CacheKey, cached_secret: CachedSecret):
+        endpoint = key[0]
+        previous = self._cache.pop(key, None)
+        if previous is None:
+            if len(self._cache) >= CACHE_MAX_SIZE:
+                self._evict(next(iter(self._cache)))
+        elif previous.value.status_code == 200:
+            self._ok_counts[endpoint] -= 1
+        if cached_secret.value.status_code == 200:
+            self._ok_counts[endpoint] += 1
+        self._cache[key] = cached_secret
+        if not KEEP_ON_CONN_FAIL:
+            # drop entries too old to be served stale. the cache is ordered by
+            # last refresh and key was just stored at the end, so walking from
+            # the front always stops at key, which is never evicted here (with
+            # SECRET_TTL <= 0 the cutoff would otherwise include it). kept
+            # when KEEP_ON_CONN_FAIL, as the fallback for a failed refresh
+            cutoff = cached_secret.last_requested - MAX_STALE_AGE
+            oldest_key = next(iter(self._cache))
+            while (
+                oldest_key != key and self._cache[oldest_key].last_requested <= cutoff
+            ):
+                self._evict(oldest_key)
+                oldest_key = next(iter(self._cache))
+        if BACKGROUND_REFRESH:
+            heapq.heappush(
+                self._expiry_heap, (cached_secret.last_requested + SECRET_TTL, key)
+            )
+            self._expiry_pushed.set()
+
+    async def _fetch_endpoint(self, key: CacheKey):
+        endpoint, secret_id = key
         try:
-            result = requests.get(
-                f"{BWSC_URL}/{url}",
-                headers={"Authorization": f"Bearer {self.token}"},
-                timeout=1,
+            result = await self.http_client.get(
+                f"/{endpoint}/{secret_id}", headers=self.headers
             )
-            value = SecretResponse(value=result.text, status_code=result.status_code)
+            value = SecretResponse(value=result.content, status_code=result.status_code)
 
-        except requests.exceptions.RequestException:
-            if KEEP_ON_CONN_FAIL and url in self.endpoint_cache:
-                value = self.endpoint_cache[url].value
+        except httpx.RequestError:
+            previous = self._cache.get(key)
+            if KEEP_ON_CONN_FAIL and previous is not None:
+                value = previous.value
             else:
-                value = SecretResponse(value="cannot connect to bwsc", status_code=500)
-        cached_secret = CachedSecret(value=value, last_requested=time.time())
-        with self.endpoint_cache_lock:
-            self.endpoint_cache[url] = cached_secret
+                value = SecretResponse(value=b"cannot connect to bwsc", status_code=500)
+        cached_secret = CachedSecret(value=value, last_requested=time.monotonic())
+        self._store(key, cached_secret)
         return cached_secret.value
 
-    def get_endpoint(self, endpoint: str, secret_id: str):
-        url = f"{endpoint}/{secret_id}"
-        with self.endpoint_cache_lock:
-            if url in self.endpoint_cache:
-                cached_secret = self.endpoint_cache[url]
-                if (
-                    cached_secret.last_requested + SECRET_TTL > time.time()
-                    or BACKGROUND_REFRESH
-                ):
-                    self.prom_client.tick_cache_hits(endpoint)
-                    return cached_secret.value
-        return self.refresh_endpoint(endpoint, secret_id)
+    async def refresh_endpoint(self, endpoint: str, secret_id: str):
+        self.prom_client.tick_cache_miss(endpoint)
+        key = (endpoint, secret_id)
+        event = self._inflight.get(key)
+        if event is not None:
+            await event.wait()
+            cached_secret = self._cache.get(key)
+            if cached_secret is not None:
+                return cached_secret.value
+            return await self._fetch_endpoint(key)
+        self._inflight[key] = asyncio.Event()
+        try:
+            return await self._fetch_endpoint(key)
+        finally:
+            self._inflight.pop(key).set()
 
-    def get_secret_by_id(self, secret_id: str):
-        return self.get_endpoint("id", secret_id)
+    async def get_endpoint(self, endpoint: str, secret_id: str):
+        key = (endpoint, secret_id)
+        cached_secret = self._cache.get(key)
+        if cached_secret is None:
+            return await self.refresh_endpoint(endpoint, secret_id)
+        age = time.monotonic() - cached_secret.last_requested
+        if age >= SECRET_TTL and not BACKGROUND_REFRESH:
+            if age >= MAX_STALE_AGE or cached_secret.value.status_code != 200:
+                return await self.refresh_endpoint(endpoint, secret_id)
+            # stale-while-revalidate: serve the stale value, refresh behind it
+            if key not in self._inflight:
+                self._spawn(self.refresh_endpoint(endpoint, secret_id))
+        self.prom_client.tick_cache_hits(endpoint)
+        return cached_secret.value
 
-    def get_secret_by_key(self, secret_key: str):
-        return self.get_endpoint("key", secret_key)
+    async def get_secret_by_id(self, secret_id: str):
+        return await self.get_endpoint("id", secret_id)
+
+    async def get_secret_by_key(self, secret_key: str):
+        return await self.get_endpoint("key", secret_key)
 
     def stats(self):
-        secret_key_count = 0
-        secret_id_count = 0
-        for url, cached_secret in self.endpoint_cache.items():
-            if cached_secret.value.status_code == 200:
-                if "key/" in url:
-                    secret_key_count += 1
-                elif "id/" in url:
-                    secret_id_count += 1
         return CacheStats(
-            secret_cache_size=secret_id_count,
-            keymap_cache_size=secret_key_count,
+            secret_cache_size=self._ok_counts["id"],
+            keymap_cache_size=self._ok_counts["key"],
         )
 
 
 class ClientManager:
     def __init__(self, prom_client: PromMetricsClient):
         self.prom_client = prom_client
+        # one connection pool shared by every token, auth is set per request
+        self.http_client = httpx.AsyncClient(
+            base_url=BWSC_URL,
+            timeout=1.0,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
         self.clients: dict[str, BwscCachedClient] = {}
 
     def get_client_by_token(self, token: str):
-        hashed_token = generate_hash(token)
-        if hashed_token not in self.clients:
-            self.clients[hashed_token] = BwscCachedClient(token, self.prom_client)
-        return self.clients[hashed_token]
+        current_time = time.monotonic()
+        client = self.clients.get(token)
+        # an idle client may have stopped its refresh loop, so start fresh
+        if client is None or current_time - client.last_used > CLIENT_IDLE_TTL:
+            self._evict_idle_clients()
+            client = self.clients[token] = BwscCachedClient(
+                token, self.prom_client, self.http_client
+            )
+        client.last_used = current_time
+        return client
+
+    def _evict_idle_clients(self):
+        # swept when a new token shows up and on each stats call (every
+        # /metrics scrape), so rotated tokens are dropped without a
+        # per-request scan
+        cutoff = time.monotonic() - CLIENT_IDLE_TTL
+        for token, client in list(self.clients.items()):
+            if client.last_used < cutoff:
+                del self.clients[token]
+                client.close()
+                self.prom_client.remove_client(client.token_hash)
+
+    async def aclose(self):
+        for client in self.clients.values():
+            client.close()
+        await self.http_client.aclose()
 
     def stats(self):
+        self._evict_idle_clients()
         total_secret_id = 0
         total_secret_key = 0
         client_stats = {}
-        for hashed_client, client in self.clients.items():
-            client_stats[hashed_client] = client.stats()
-            total_secret_id += client_stats[hashed_client].secret_cache_size
-            total_secret_key += client_stats[hashed_client].keymap_cache_size
+        for client in self.clients.values():
+            client_stats[client.token_hash] = client.stats()
+            total_secret_id += client_stats[client.token_hash].secret_cache_size
+            total_secret_key += client_stats[client.token_hash].keymap_cache_size
         return StatsResponse(
             num_clients=len(self.clients),
             client_stats=client_stats,
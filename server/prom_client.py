@@ -1,9 +1,14 @@
+from typing import Any, TypeVar
+
 from prometheus_client import Counter, Gauge
 from prometheus_client import REGISTRY
+from prometheus_client.metrics import MetricWrapperBase
 from prometheus_client.exposition import choose_encoder
 
 from models import StatsResponse
 
+M = TypeVar("M", bound=MetricWrapperBase)
+
 
 class PromMetricsClient:
     REGISTRY = REGISTRY
@@ -19,36 +24,52 @@ class PromMetricsClient:
         self.http_request_duration = Gauge(
             "http_request_duration", "http request duration", ["endpoint"]
         )
+        # bound label children, so repeat ticks skip labels() resolution
+        self._children: dict[tuple[MetricWrapperBase, tuple[str, ...]], Any] = {}
+
+    def _labels(self, metric: M, *labelvalues: str) -> M:
+        key = (metric, labelvalues)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = metric.labels(*labelvalues)
+        return child
 
     def tick_cache_hits(self, type: str):
-        self.cache_hit.labels(type=type).inc()
+        self._labels(self.cache_hit, type).inc()
 
     def tick_cache_miss(self, type: str):
-        self.cache_miss.labels(type=type).inc()
+        self._labels(self.cache_miss, type).inc()
 
     def tick_http_request_total(self, endpoint: str, status_code: str):
-        self.http_request_total.labels(endpoint=endpoint, status_code=status_code).inc()
+        self._labels(self.http_request_total, endpoint, status_code).inc()
 
     def tick_http_request_duration(self, endpoint: str, duration):
-        self.http_request_duration.labels(endpoint=endpoint).set(duration)
+        self._labels(self.http_request_duration, endpoint).set(duration)
 
     def tick_stats(self, stats: StatsResponse):
         self.num_clients.set(stats.num_clients)
         for client, client_stats in stats.client_stats.items():
-            self.cache_size.labels(type="secret", client=client).set(
+            self._labels(self.cache_size, "secret", client).set(
                 client_stats.secret_cache_size
             )
-            self.cache_size.labels(type="keymap", client=client).set(
+            self._labels(self.cache_size, "keymap", client).set(
                 client_stats.keymap_cache_size
             )
-        self.cache_size.labels(type="secret", client="total").set(
+        self._labels(self.cache_size, "secret", "total").set(
             stats.total_stats.secret_cache_size
         )
-        self.cache_size.labels(type="keymap", client="total").set(
+        self._labels(self.cache_size, "keymap", "total").set(
             stats.total_stats.keymap_cache_size
         )
 
+    def remove_client(self, client: str):
+        for type in ("secret", "keymap"):
+            self._children.pop((self.cache_size, (type, client)), None)
+            try:
+                self.cache_size.remove(type, client)
+            except KeyError:
+                pass
+
     def generate_metrics(self, accept_header):
         generate_latest, content_type = choose_encoder(accept_header)
-        generated_content = generate_latest(self.REGISTRY).decode("utf-8")
-        return generated_content, content_type
+        return generate_latest(self.REGISTRY), content_type
@@ -1,9 +1,12 @@
 import logging
 import os
+import re
 import time
+from contextlib import asynccontextmanager
 from typing import Annotated
 
 from client import (
+    BwscCachedClient,
     ClientManager,
 )
 from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response
@@ -50,30 +53,32 @@ ch = logging.StreamHandler()
 ch.setFormatter(formatter)
 root_logger.addHandler(ch)
 
-api = FastAPI()
+
+@asynccontextmanager
+async def lifespan(api: FastAPI):
+    yield
+    await client_manager.aclose()
+
+
+api = FastAPI(lifespan=lifespan)
 
 
 prom_client = PromMetricsClient()
 client_manager = ClientManager(prom_client)
 
 
+ENDPOINT_RE = re.compile(r"^(/reset|/id|/key)(?:/|$)")
+
+
 @api.middleware("http")
 async def prom_middleware(request: Request, call_next):
-    api_mapping = [
-        "/reset",
-        "/id",
-        "/key",
-    ]
-    endpoint = None
-    for api_endpoint in api_mapping:
-        if request.url.path.startswith(api_endpoint):
-            endpoint = request.url.path
+    match = ENDPOINT_RE.match(request.url.path)
+    endpoint = match.group(1) if match else None
     st = time.time()
     return_data: Response = await call_next(request)
     if endpoint and isinstance(return_data, Response):
         prom_client.tick_http_request_total(endpoint, str(return_data.status_code))
         prom_client.tick_http_request_duration(endpoint, time.time() - st)
-    prom_client.tick_stats(client_manager.stats())
     return return_data
 
 
@@ -94,12 +99,16 @@ def custom_openapi():
 api.openapi = custom_openapi
 
 
-def handle_auth(authorization: Annotated[str, Header()]):
+async def handle_auth(authorization: Annotated[str, Header()]):
     if authorization.startswith("Bearer "):
         return authorization.split()[-1]
     raise HTTPException(status_code=401, detail="Invalid token")
 
 
+async def get_client(authorization: Annotated[str, Depends(handle_auth)]):
+    return client_manager.get_client_by_token(authorization)
+
+
 @api.get(
     "/reset",
     response_model=ResetResponse,
@@ -107,8 +116,7 @@ def handle_auth(authorization: Annotated[str, Header()]):
         401: {"model": ErrorResponse, "description": "Invalid or unauthorised token"},
     },
 )
-def reset_cache(authorization: Annotated[str, Depends(handle_auth)]):
-    client = client_manager.get_client_by_token(authorization)
+async def reset_cache(client: Annotated[BwscCachedClient, Depends(get_client)]):
     stats = client.reset_cache()
     return ResetResponse(
         status="success",
@@ -129,9 +137,10 @@ def reset_cache(authorization: Annotated[str, Depends(handle_auth)]):
         },
     },
 )
-def get_id(authorization: Annotated[str, Depends(handle_auth)], secret_id: str):
-    client = client_manager.get_client_by_token(authorization)
-    secret = client.get_secret_by_id(secret_id)
+async def get_id(
+    client: Annotated[BwscCachedClient, Depends(get_client)], secret_id: str
+):
+    secret = await client.get_secret_by_id(secret_id)
     return Response(content=secret.value, status_code=secret.status_code)
 
 
@@ -147,12 +156,11 @@ def get_id(authorization: Annotated[str, Depends(handle_auth)], secret_id: str):
         },
     },
 )
-def get_key(
-    authorization: Annotated[str, Depends(handle_auth)],
+async def get_key(
+    client: Annotated[BwscCachedClient, Depends(get_client)],
     secret_key: str,
 ):
-    client = client_manager.get_client_by_token(authorization)
-    secret = client.get_secret_by_key(secret_key)
+    secret = await client.get_secret_by_key(secret_key)
     return Response(content=secret.value, status_code=secret.status_code)
 
 
@@ -172,7 +180,8 @@ def get_key(
         },
     },
 )
-def prometheus_metrics(accept: Annotated[str | str, Header()] = ""):
+async def prometheus_metrics(accept: Annotated[str | str, Header()] = ""):
+    prom_client.tick_stats(client_manager.stats())
     generated_data, content_type = prom_client.generate_metrics(accept)
     headers = {"Content-Type": content_type}
     return PlainTextResponse(generated_data, headers=headers)
@@ -189,10 +198,12 @@ def prometheus_metrics(accept: Annotated[str | str, Header()] = ""):
         500: {"model": ErrorResponse, "description": "Internal server error"},
     },
 )
-def get_stats():
-    return client_manager.stats()
+async def get_stats():
+    return Response(
+        client_manager.stats().model_dump_json(), media_type="application/json"
+    )
 
 
 @api.get("/healthcheck", response_model=HealthcheckResponse)
-def healthcheck():
+async def healthcheck():
     return {"status": "I'm alive"}